@@ -6,7 +6,7 @@ mod mv;
 mod piece;
 mod square;
 
-pub use board::{Board, START_POS_FEN, make_move, gen_legal_moves};
+pub use board::{Board, Castles, START_POS_FEN, make_move, gen_legal_moves};
 pub use color::*;
 pub use magic_tables::init_magic_tables;
 pub use mv::*;
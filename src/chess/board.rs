@@ -4,6 +4,7 @@ use super::magic_tables;
 use super::mv::{Move, MoveType};
 use super::piece::*;
 use super::square::*;
+use crate::ZOBRIST_HASHER;
 
 pub const START_POS_FEN: &'static str = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1";
 
@@ -43,12 +44,31 @@ impl Castles {
         self.0 &= !(castle as u8);
     }
 
+    #[inline]
+    pub const fn retain(&mut self, castles: Castles) {
+        self.0 &= castles.0;
+    }
+
     #[inline]
     pub const fn idx(&self) -> usize {
         self.0 as usize
     }
 }
 
+// The castles still allowed after a move from or to each square
+const CASTLES_KEPT: [Castles; NUM_SQUARES] = {
+    let mut kept = [Castles::ALL; NUM_SQUARES];
+    kept[Square::E1.idx()].unset(Castle::WK);
+    kept[Square::E1.idx()].unset(Castle::WQ);
+    kept[Square::H1.idx()].unset(Castle::WK);
+    kept[Square::A1.idx()].unset(Castle::WQ);
+    kept[Square::E8.idx()].unset(Castle::BK);
+    kept[Square::E8.idx()].unset(Castle::BQ);
+    kept[Square::H8.idx()].unset(Castle::BK);
+    kept[Square::A8.idx()].unset(Castle::BQ);
+    kept
+};
+
 pub const CASTLE_WK_MOVE: Move = Move {
     from: Square::E1,
     to: Square::G1,
@@ -81,39 +101,46 @@ pub const CASTLE_BQ_MOVE: Move = Move {
 //     InsufficientMaterial
 // }
 
-// struct MoveUndoer {
-//     mv: Move,
-//     captured: Option<(Piece, Color)>,
-//     en_passant: Option<Square>,
-//     castling: Castles,
-//     halfmoves: u32
-// }
+#[derive(Debug, Clone, Copy)]
+pub struct MoveUndoer {
+    mv: Move,
+    captured: Option<Piece>,
+    en_passant: Option<Square>,
+    castles: Castles,
+    halfmoves: u8,
+    hash: u64
+}
 
 #[derive(Clone, Copy)]
 pub struct Board {
     pieces: [Bitboard; 6],
     colors: [Bitboard; 2],
+    mailbox: [Option<Piece>; NUM_SQUARES],
     side_to_move: Color,
     castles: Castles,
     en_passant: Option<Square>,
     halfmoves: u8,
+    hash: u64,
 }
 
 impl Board {
     pub fn new(fen: &str) -> Option<Self> {
         if !fen.is_ascii() || fen.is_empty() { return None; }
 
+        let mut fields = fen.trim().split(' ');
         let [
             board, side_to_move, allowed_castling, en_passant, halfmove_count, fullmove_num
-        ] = fen.trim().split(" ").collect::<Vec<_>>().try_into().ok()?;
+        ] = [fields.next()?, fields.next()?, fields.next()?, fields.next()?, fields.next()?, fields.next()?];
+        if fields.next().is_some() { return None; }
 
         // Board
         let mut pieces = [Bitboard::EMPTY; NUM_PIECES];
         let mut colors = [Bitboard::EMPTY; NUM_COLORS];
+        let mut mailbox = [None; NUM_SQUARES];
 
         // TODO: check for repeated numbers (e.g. "44") in fen
         let mut rank = b'8';
-        for row in board.split("/") {
+        for row in board.split('/') {
             if rank < b'1' { return None; }
 
             let mut file = b'a';
@@ -127,9 +154,11 @@ impl Board {
                 else if let Some(piece) = Piece::from_ascii(char) {
                     let color = if char.is_ascii_uppercase() { Color::White } else { Color::Black };
 
-                    let bb = Bitboard::from_square(Square::from_coords(File::from_ascii(file), Rank::from_ascii(rank)));
+                    let square = Square::from_idx(8 * (rank - b'1') as usize + (file - b'a') as usize);
+                    let bb = Bitboard::from_square(square);
                     pieces[piece.idx()] ^= bb;
                     colors[color.idx()] ^= bb;
+                    mailbox[square.idx()] = Some(piece);
                     file += 1;
                 }
                 else {
@@ -150,10 +179,15 @@ impl Board {
 
         // Castling avilability
         let mut castles = Castles::NONE;
-        if allowed_castling.contains("K") { castles.set(Castle::WK); }
-        if allowed_castling.contains("Q") { castles.set(Castle::WQ); }
-        if allowed_castling.contains("k") { castles.set(Castle::BK); }
-        if allowed_castling.contains("q") { castles.set(Castle::BQ); }
+        for char in allowed_castling.bytes() {
+            match char {
+                b'K' => castles.set(Castle::WK),
+                b'Q' => castles.set(Castle::WQ),
+                b'k' => castles.set(Castle::BK),
+                b'q' => castles.set(Castle::BQ),
+                _ => {}
+            }
+        }
 
         // En passant
         let en_passant = match en_passant {
@@ -166,7 +200,9 @@ impl Board {
         // Fullmove num
         let Ok(_) = fullmove_num.parse::<u32>() else { return None; };
 
-        Some(Self { pieces, colors, side_to_move, castles, en_passant, halfmoves })
+        let mut board = Self { pieces, colors, mailbox, side_to_move, castles, en_passant, halfmoves, hash: 0 };
+        board.hash = ZOBRIST_HASHER.hash(&board);
+        Some(board)
     }
 
     #[inline]
@@ -194,34 +230,14 @@ impl Board {
         self.castles
     }
 
-    pub fn get_piece_at(&self, square: Square) -> Option<Piece> {
-        let square = Bitboard::from_square(square);
+    #[inline(always)]
+    pub const fn get_hash(&self) -> u64 {
+        self.hash
+    }
 
-        if (self.pieces[Piece::Rook.idx()] | self.pieces[Piece::Knight.idx()] | self.pieces[Piece::Bishop.idx()]) & square != Bitboard::EMPTY {
-            if self.pieces[Piece::Rook.idx()] & square != Bitboard::EMPTY {
-                return Some(Piece::Rook);
-            }
-            if self.pieces[Piece::Knight.idx()] & square != Bitboard::EMPTY {
-                return Some(Piece::Knight);
-            }
-            return Some(Piece::Bishop);
-        }
-        else if (self.pieces[Piece::Queen.idx()] | self.pieces[Piece::King.idx()] | self.pieces[Piece::Pawn.idx()]) & square != Bitboard::EMPTY {
-            if self.pieces[Piece::Queen.idx()] & square != Bitboard::EMPTY {
-                return Some(Piece::Queen);
-            }
-            if self.pieces[Piece::King.idx()] & square != Bitboard::EMPTY {
-                return Some(Piece::King);
-            }
-            return Some(Piece::Pawn);
-        }
-        return None;
-        // for (piece, bitboard) in PIECES.into_iter().zip(&self.pieces) {
-        //     if *bitboard & square != Bitboard::EMPTY {
-        //         return Some(piece);
-        //     }
-        // }
-        // None
+    #[inline]
+    pub const fn get_piece_at(&self, square: Square) -> Option<Piece> {
+        self.mailbox[square.idx()]
     }
 
     pub fn get_color_at(&self, square: Square) -> Option<Color> {
@@ -242,10 +258,19 @@ impl Board {
         self.colors[Color::White.idx()] | self.colors[Color::Black.idx()]
     }
 
+    #[inline(always)]
+    pub fn king_square(&self, color: Color) -> Square {
+        (self.pieces[Piece::King.idx()] & self.colors[color.idx()]).to_square()
+    }
+
     #[inline]
     pub fn is_check(&self) -> bool {
-        self.pieces[Piece::King.idx()] & self.colors[(!self.side_to_move).idx()]
-        & gen_attacks(self, self.side_to_move, self.blockers()) != Bitboard::EMPTY
+        is_attacked(self, self.king_square(self.side_to_move), !self.side_to_move, self.blockers())
+    }
+
+    #[inline]
+    pub fn is_checkmate(&self) -> bool {
+        self.is_check() && !has_legal_moves(self)
     }
 }
 
@@ -305,164 +330,304 @@ impl std::fmt::Debug for Board {
 }
 
 pub fn make_move(board: &Board, mv: Move) -> Board {
+    let mut board = *board;
+    board.make(mv);
+    board
+}
+
+#[inline(always)]
+const fn castle_rook_squares(to: Square, color: Color) -> (Square, Square) {
+    let [from_file, to_file] = match to.file() {
+        File::C => [File::A, File::D],
+        File::G => [File::H, File::F],
+        _ => unreachable!()
+    };
+    let rank = match color {
+        Color::White => Rank::One,
+        Color::Black => Rank::Eight
+    };
+    (Square::from_coords(from_file, rank), Square::from_coords(to_file, rank))
+}
+
+impl Board {
     #[inline(always)]
-    fn xor(pieces: &mut [Bitboard; 6], colors: &mut [Bitboard; 2], bitboard: Bitboard, piece: Piece, color: Color) {
-        pieces[piece.idx()] ^= bitboard;
-        colors[color.idx()] ^= bitboard;
+    fn xor(&mut self, bitboard: Bitboard, piece: Piece, color: Color) {
+        self.pieces[piece.idx()] ^= bitboard;
+        self.colors[color.idx()] ^= bitboard;
     }
 
-    // Only legal moves should make it to this function
-    let from_bb = Bitboard::from_square(mv.from);
-    let to_bb = Bitboard::from_square(mv.to);
+    pub fn make(&mut self, mv: Move) -> MoveUndoer {
+        // Play `mv` in place, returning what's needed to take it back with `unmake`.
+        // Only legal moves should make it to this function
+        let from_bb = Bitboard::from_square(mv.from);
+        let to_bb = Bitboard::from_square(mv.to);
+
+        let piece = self.get_piece_at(mv.from).unwrap();
+        let captured = self.get_piece_at(mv.to);
+        let color = self.side_to_move;
+
+        let undoer = MoveUndoer {
+            mv,
+            captured,
+            en_passant: self.en_passant,
+            castles: self.castles,
+            halfmoves: self.halfmoves,
+            hash: self.hash
+        };
+
+        // Make the swap
+        let end_piece = match mv.move_type {
+            MoveType::Promotion(to) => to,
+            _ => piece
+        };
 
-    let piece = board.get_piece_at(mv.from).unwrap();
-    let captured = board.get_piece_at(mv.to);
+        self.xor(from_bb, piece, color);
+        self.xor(to_bb, end_piece, color);
+        self.hash ^= ZOBRIST_HASHER.piece(piece, color, mv.from) ^ ZOBRIST_HASHER.piece(end_piece, color, mv.to);
+        if let Some(captured) = captured {
+            self.xor(to_bb, captured, !color);
+            self.hash ^= ZOBRIST_HASHER.piece(captured, !color, mv.to);
+        }
+        self.mailbox[mv.from.idx()] = None;
+        self.mailbox[mv.to.idx()] = Some(end_piece);
+
+        // Castling move
+        if mv.move_type == MoveType::Castle {
+            let (rook_from, rook_to) = castle_rook_squares(mv.to, color);
+            self.xor(Bitboard::from_square(rook_from), Piece::Rook, color);
+            self.xor(Bitboard::from_square(rook_to), Piece::Rook, color);
+            self.hash ^= ZOBRIST_HASHER.piece(Piece::Rook, color, rook_from) ^ ZOBRIST_HASHER.piece(Piece::Rook, color, rook_to);
+            self.mailbox[rook_from.idx()] = None;
+            self.mailbox[rook_to.idx()] = Some(Piece::Rook);
+        }
 
-    // Make the swap
-    let mut pieces = board.pieces;
-    let mut colors = board.colors;
+        // En passant capture
+        if mv.move_type == MoveType::EnPassant {
+            let captured_square = Square::from_coords(mv.to.file(), mv.from.rank());
+            self.xor(Bitboard::from_square(captured_square), Piece::Pawn, !color);
+            self.hash ^= ZOBRIST_HASHER.piece(Piece::Pawn, !color, captured_square);
+            self.mailbox[captured_square.idx()] = None;
+        }
 
-    let end_piece = match mv.move_type {
-        MoveType::Promotion(to) => to,
-        _ => piece
-    };
+        // Update turn
+        self.side_to_move = !color;
+        self.hash ^= ZOBRIST_HASHER.side_to_move();
 
-    xor(&mut pieces, &mut colors, from_bb, piece, board.side_to_move);
-    xor(&mut pieces, &mut colors, to_bb, end_piece, board.side_to_move);
-    if let Some(captured) = captured {
-        xor(&mut pieces, &mut colors, to_bb, captured, !board.side_to_move);
-    }
+        // Update castles
+        self.hash ^= ZOBRIST_HASHER.castles(self.castles);
+        self.castles.retain(CASTLES_KEPT[mv.from.idx()]);
+        self.castles.retain(CASTLES_KEPT[mv.to.idx()]);
+        self.hash ^= ZOBRIST_HASHER.castles(self.castles);
 
-    // Castling move
-    if mv.move_type == MoveType::Castle {
-        let [from_file, to_file] = match mv.to.file() {
-            File::C => [File::A, File::D],
-            File::G => [File::H, File::F],
-            _ => unreachable!()
+        // Update en passant square
+        if let Some(en_passant) = self.en_passant {
+            self.hash ^= ZOBRIST_HASHER.en_passant(en_passant);
+        }
+        self.en_passant = match mv.move_type {
+            MoveType::FirstPawnMove => Some(mv.to.backward(color).unwrap()),
+            _ => None
         };
-        let rank = match board.side_to_move {
-            Color::White => Rank::One,
-            Color::Black => Rank::Eight
+        if let Some(en_passant) = self.en_passant {
+            self.hash ^= ZOBRIST_HASHER.en_passant(en_passant);
+        }
+
+        // Update halfmove count
+        self.halfmoves = if piece == Piece::Pawn || captured.is_some() || mv.move_type == MoveType::EnPassant {
+            0
+        } else {
+            self.halfmoves.saturating_add(1)
         };
-        xor(&mut pieces, &mut colors, Bitboard::from_square(Square::from_coords(from_file, rank)), Piece::Rook, board.side_to_move);
-        xor(&mut pieces, &mut colors, Bitboard::from_square(Square::from_coords(to_file, rank)), Piece::Rook, board.side_to_move);
-    }
 
-    // En passant capture
-    if mv.move_type == MoveType::EnPassant {
-        xor(&mut pieces, &mut colors, Bitboard::from_square(
-            Square::from_coords(mv.to.file(), mv.from.rank())
-        ), Piece::Pawn, !board.side_to_move);
+        debug_assert_eq!(self.hash, ZOBRIST_HASHER.hash(self), "incremental hash out of sync after making {}", mv);
+        undoer
     }
 
-    // Update turn
-    let side_to_move = !board.side_to_move;
+    pub fn unmake(&mut self, undoer: MoveUndoer) {
+        // Take back the move recorded in `undoer`, which must be the last move made on this board
+        let MoveUndoer { mv, captured, en_passant, castles, halfmoves, hash } = undoer;
 
-    // Update castles
-    const CASTLE_POINTS: Bitboard = Bitboard(
-        Bitboard::from_square(Square::A1).0 | Bitboard::from_square(Square::E1).0 | Bitboard::from_square(Square::H1).0 |
-        Bitboard::from_square(Square::A8).0 | Bitboard::from_square(Square::E8).0 | Bitboard::from_square(Square::H8).0
-    );
+        let from_bb = Bitboard::from_square(mv.from);
+        let to_bb = Bitboard::from_square(mv.to);
 
-    let mut castles = board.castles;
+        let color = !self.side_to_move;
+        self.side_to_move = color;
 
-    let move_bb = from_bb | to_bb;
-    if move_bb & CASTLE_POINTS != Bitboard::EMPTY {
-        if move_bb & Bitboard::from_square(Square::E1) != Bitboard::EMPTY {
-            castles.unset(Castle::WK);
-            castles.unset(Castle::WQ);
-        } else if move_bb & Bitboard::from_square(Square::E8) != Bitboard::EMPTY {
-            castles.unset(Castle::BK);
-            castles.unset(Castle::BQ);
+        let end_piece = self.get_piece_at(mv.to).unwrap();
+        let piece = match mv.move_type {
+            MoveType::Promotion(_) => Piece::Pawn,
+            _ => end_piece
+        };
+
+        // Undo the swap
+        self.xor(to_bb, end_piece, color);
+        self.xor(from_bb, piece, color);
+        if let Some(captured) = captured {
+            self.xor(to_bb, captured, !color);
         }
-        else {
-            if move_bb & Bitboard::from_square(Square::H1) != Bitboard::EMPTY {
-                castles.unset(Castle::WK);
-            }
-            if move_bb & Bitboard::from_square(Square::A1) != Bitboard::EMPTY {
-                castles.unset(Castle::WQ);
-            }
-            if move_bb & Bitboard::from_square(Square::H8) != Bitboard::EMPTY {
-                castles.unset(Castle::BK);
-            }
-            if move_bb & Bitboard::from_square(Square::A8) != Bitboard::EMPTY {
-                castles.unset(Castle::BQ);
-            }
+        self.mailbox[mv.from.idx()] = Some(piece);
+        self.mailbox[mv.to.idx()] = captured;
+
+        // Castling move
+        if mv.move_type == MoveType::Castle {
+            let (rook_from, rook_to) = castle_rook_squares(mv.to, color);
+            self.xor(Bitboard::from_square(rook_to), Piece::Rook, color);
+            self.xor(Bitboard::from_square(rook_from), Piece::Rook, color);
+            self.mailbox[rook_to.idx()] = None;
+            self.mailbox[rook_from.idx()] = Some(Piece::Rook);
         }
-    }
 
-    // Update en passant square
-    let en_passant = match mv.move_type {
-        MoveType::FirstPawnMove => Some(mv.to.backward(board.side_to_move).unwrap()),
-        _ => None
-    };
+        // En passant capture
+        if mv.move_type == MoveType::EnPassant {
+            let captured_square = Square::from_coords(mv.to.file(), mv.from.rank());
+            self.xor(Bitboard::from_square(captured_square), Piece::Pawn, !color);
+            self.mailbox[captured_square.idx()] = Some(Piece::Pawn);
+        }
 
-    // Update halfmove count
-    let halfmoves = if piece == Piece::Pawn || captured.is_some() || mv.move_type == MoveType::EnPassant {
-        0
-    } else {
-        board.halfmoves + 1
-    };
+        self.castles = castles;
+        self.en_passant = en_passant;
+        self.halfmoves = halfmoves;
+        self.hash = hash;
 
-    Board {
-        pieces,
-        colors,
-        side_to_move,
-        castles,
-        en_passant,
-        halfmoves
+        debug_assert_eq!(self.hash, ZOBRIST_HASHER.hash(self), "incremental hash out of sync after unmaking {}", mv);
     }
 }
 
 pub fn gen_legal_moves(board: &Board, v: &mut Vec<Move>) {
-    let mut pseudolegals = Vec::new();
+    // Pseudolegal moves are written straight into `v`, then illegal ones are compacted out in place
+    let start = v.len();
     let blockers = board.blockers();
 
     for piece in PIECES {
         for square in board.pieces[piece.idx()] & board.colors[board.side_to_move.idx()] {
-            gen_piece_moves(board, piece, square, blockers, &mut pseudolegals);
+            gen_piece_moves(board, piece, square, blockers, v);
         }
     }
 
     // Legality check
-    v.extend(pseudolegals.into_iter()
-        .filter(|&mv| {
-            let board = make_move(board, mv);
-            board.pieces[Piece::King.idx()] & board.colors[(!board.side_to_move).idx()]
-            & gen_attacks(&board, board.side_to_move, board.blockers()) == Bitboard::EMPTY
-        })
-    );
+    let mut scratch = *board;
+    let king = board.king_square(board.side_to_move);
+    let exposing = exposing_squares(board, king, blockers);
+    let mut kept = start;
+    for i in start..v.len() {
+        let mv = v[i];
+        if is_legal(&mut scratch, mv, king, exposing) {
+            v[kept] = mv;
+            kept += 1;
+        }
+    }
+    v.truncate(kept);
+}
+
+pub fn has_legal_moves(board: &Board) -> bool {
+    // Like `gen_legal_moves`, but stops at the first legal move found, trying each piece's targets straight off its bitboards.
+    // Castling is skipped, since the king's one-square step toward the rook is legal whenever castling is
+    let color = board.side_to_move;
+    let own = board.colors[color.idx()];
+    let blockers = board.blockers();
+    let mut scratch = *board;
+    let king = board.king_square(color);
+    let exposing = exposing_squares(board, king, blockers);
+    let mut any_legal = |from: Square, targets: Bitboard, move_type: MoveType| targets.into_iter()
+        .any(|to| is_legal(&mut scratch, Move { from, to, move_type }, king, exposing));
+
+    for piece in PIECES {
+        for square in board.pieces[piece.idx()] & own {
+            let found = match piece {
+                Piece::Rook => any_legal(square, magic_tables::get_rook_moves(square, blockers) & !own, MoveType::Basic),
+                Piece::Knight => any_legal(square, KNIGHT_MOVES[square.idx()] & !own, MoveType::Basic),
+                Piece::Bishop => any_legal(square, magic_tables::get_bishop_moves(square, blockers) & !own, MoveType::Basic),
+                Piece::Queen => any_legal(square, magic_tables::get_queen_moves(square, blockers) & !own, MoveType::Basic),
+                Piece::King => any_legal(square, KING_MOVES[square.idx()] & !own, MoveType::Basic),
+                Piece::Pawn => {
+                    // The piece promoted to doesn't affect legality, so promotions are only tried as a queen
+                    let move_type = if square.rank() == match color {
+                        Color::White => Rank::Seven,
+                        Color::Black => Rank::Two
+                    } {
+                        MoveType::Promotion(Piece::Queen)
+                    } else {
+                        MoveType::Basic
+                    };
+
+                    let fwd = square.forward(color).unwrap();
+                    let fwd_empty = blockers & Bitboard::from_square(fwd) == Bitboard::EMPTY;
+                    let captures = PAWN_ATTACKS[color.idx()][square.idx()];
+
+                    (fwd_empty && any_legal(square, Bitboard::from_square(fwd), move_type))
+                    || any_legal(square, captures & board.colors[(!color).idx()], move_type)
+                    || (fwd_empty && square.rank() == match color {
+                        Color::White => Rank::Two,
+                        Color::Black => Rank::Seven
+                    } && {
+                        let fwd_2 = fwd.forward(color).unwrap();
+                        blockers & Bitboard::from_square(fwd_2) == Bitboard::EMPTY
+                        && any_legal(square, Bitboard::from_square(fwd_2), MoveType::FirstPawnMove)
+                    })
+                    || board.en_passant.is_some_and(|ep| any_legal(square, captures & Bitboard::from_square(ep), MoveType::EnPassant))
+                }
+            };
+            if found {
+                return true;
+            }
+        }
+    }
+    false
+}
+
+#[inline]
+fn exposing_squares(board: &Board, king: Square, blockers: Bitboard) -> Bitboard {
+    // The squares a piece might be moving from if its move leaves the king on `king` attacked.
+    // If the king isn't already in check, only the king itself or a piece on one of its lines can do that
+    if is_attacked(board, king, !board.side_to_move, blockers) {
+        !Bitboard::EMPTY
+    } else {
+        magic_tables::get_queen_moves(king, Bitboard::EMPTY) | Bitboard::from_square(king)
+    }
+}
+
+#[inline]
+fn is_legal(scratch: &mut Board, mv: Move, king: Square, exposing: Bitboard) -> bool {
+    // Check that a pseudolegal move doesn't leave the mover's king (on `king` before the move) attacked.
+    // `scratch` is left unchanged
+
+    // Moves from outside `exposing` are always legal, except en passant, which also removes the captured pawn
+    if exposing & Bitboard::from_square(mv.from) == Bitboard::EMPTY && mv.move_type != MoveType::EnPassant {
+        return true;
+    }
+
+    let color = scratch.side_to_move;
+    let king = if mv.from == king { mv.to } else { king };
+    let undoer = scratch.make(mv);
+    let legal = !is_attacked(scratch, king, !color, scratch.blockers());
+    scratch.unmake(undoer);
+    legal
 }
 
 fn gen_piece_moves(board: &Board, piece: Piece, square: Square, blockers: Bitboard, v: &mut Vec<Move>) {
+    let own = board.colors[board.side_to_move.idx()];
     match piece {
         Piece::Rook => {
-            v.extend(magic_tables::get_rook_moves(square, blockers)
-                .filter(|&to| board.colors[board.side_to_move.idx()] & Bitboard::from_square(to) == Bitboard::EMPTY)
+            v.extend((magic_tables::get_rook_moves(square, blockers) & !own)
                 .map(|to| Move { from: square, to, move_type: MoveType::Basic })
             );
         },
         Piece::Knight => {
-            v.extend(KNIGHT_MOVES[square.idx()]
-                .filter(|&to| board.colors[board.side_to_move.idx()] & Bitboard::from_square(to) == Bitboard::EMPTY)
+            v.extend((KNIGHT_MOVES[square.idx()] & !own)
                 .map(|to| Move { from: square, to, move_type: MoveType::Basic })
             );
         },
         Piece::Bishop => {
-            v.extend(magic_tables::get_bishop_moves(square, blockers)
-                .filter(|&to| board.colors[board.side_to_move.idx()] & Bitboard::from_square(to) == Bitboard::EMPTY)
+            v.extend((magic_tables::get_bishop_moves(square, blockers) & !own)
                 .map(|to| Move { from: square, to, move_type: MoveType::Basic })
             );
         },
         Piece::Queen => {
-            v.extend(magic_tables::get_queen_moves(square, blockers)
-                .filter(|&to| board.colors[board.side_to_move.idx()] & Bitboard::from_square(to) == Bitboard::EMPTY)
+            v.extend((magic_tables::get_queen_moves(square, blockers) & !own)
                 .map(|to| Move { from: square, to, move_type: MoveType::Basic })
             );
         },
         Piece::King => {
-            v.extend(KING_MOVES[square.idx()]
-                .filter(|&to| board.colors[board.side_to_move.idx()] & Bitboard::from_square(to) == Bitboard::EMPTY)
+            v.extend((KING_MOVES[square.idx()] & !own)
                 .map(|to| Move { from: square, to, move_type: MoveType::Basic })
             );
 
@@ -476,41 +641,53 @@ fn gen_piece_moves(board: &Board, piece: Piece, square: Square, blockers: Bitboa
             const CASTLE_BK_UNATTACKED: Bitboard = Bitboard(Bitboard::from_square(Square::E8).0 | Bitboard::from_square(Square::F8).0 | Bitboard::from_square(Square::G8).0);
             const CASTLE_BQ_UNATTACKED: Bitboard = Bitboard(Bitboard::from_square(Square::C8).0 | Bitboard::from_square(Square::D8).0 | Bitboard::from_square(Square::E8).0);
 
-            let attacks = gen_attacks(board, !board.side_to_move, blockers);
+            // Only look for attacks on the castling squares once the cheaper checks have passed
+            let attacked = |squares: Bitboard| squares.into_iter()
+                .any(|square| is_attacked(board, square, !board.side_to_move, blockers));
 
             match board.side_to_move {
                 Color::White => {
                     if board.castles.is_set(Castle::WK)
                     && blockers & CASTLE_WK_EMPTY == Bitboard::EMPTY
-                    && attacks & CASTLE_WK_UNATTACKED == Bitboard::EMPTY {
+                    && !attacked(CASTLE_WK_UNATTACKED) {
                         v.push(CASTLE_WK_MOVE);
                     }
                     if board.castles.is_set(Castle::WQ)
                     && blockers & CASTLE_WQ_EMPTY == Bitboard::EMPTY
-                    && attacks & CASTLE_WQ_UNATTACKED == Bitboard::EMPTY {
+                    && !attacked(CASTLE_WQ_UNATTACKED) {
                         v.push(CASTLE_WQ_MOVE);
                     }
                 },
                 Color::Black => {
                     if board.castles.is_set(Castle::BK)
                     && blockers & CASTLE_BK_EMPTY == Bitboard::EMPTY
-                    && attacks & CASTLE_BK_UNATTACKED == Bitboard::EMPTY {
+                    && !attacked(CASTLE_BK_UNATTACKED) {
                         v.push(CASTLE_BK_MOVE);
                     }
                     if board.castles.is_set(Castle::BQ)
                     && blockers & CASTLE_BQ_EMPTY == Bitboard::EMPTY
-                    && attacks & CASTLE_BQ_UNATTACKED == Bitboard::EMPTY {
+                    && !attacked(CASTLE_BQ_UNATTACKED) {
                         v.push(CASTLE_BQ_MOVE);
                     }
                 }
             }
         },
         Piece::Pawn => {
-            let mut pawn_moves = Vec::new();
+            // If on promotion rank, every move is pushed as its promotions
+            let promotes = square.rank() == match board.side_to_move {
+                Color::White => Rank::Seven,
+                Color::Black => Rank::Two
+            };
+            let mut push = |to: Square, move_type: MoveType| if promotes {
+                v.extend(Move::promotions(square, to));
+            } else {
+                v.push(Move { from: square, to, move_type });
+            };
+
             // Forward 1
             let fwd = square.forward(board.side_to_move).unwrap();
             if blockers & Bitboard::from_square(fwd) == Bitboard::EMPTY {
-                pawn_moves.push(Move { from: square, to: fwd, move_type: MoveType::Basic });
+                push(fwd, MoveType::Basic);
 
                 // Forward 2
                 if square.rank() == match board.side_to_move {
@@ -520,70 +697,48 @@ fn gen_piece_moves(board: &Board, piece: Piece, square: Square, blockers: Bitboa
                     let fwd_2 = square.forward(board.side_to_move).unwrap()
                                             .forward(board.side_to_move).unwrap();
                     if blockers & Bitboard::from_square(fwd_2) == Bitboard::EMPTY {
-                        pawn_moves.push(Move { from: square, to: fwd_2, move_type: MoveType::FirstPawnMove });
+                        push(fwd_2, MoveType::FirstPawnMove);
                     }
                 }
             }
 
-            // Capture left
-            if let Some(capture) = PAWN_LEFT_CAPTURES[board.side_to_move.idx()][square.idx()] {
-                if board.colors[(!board.side_to_move).idx()] & Bitboard::from_square(capture) != Bitboard::EMPTY {
-                    pawn_moves.push(Move { from: square, to: capture, move_type: MoveType::Basic });
-                }
-                else if board.en_passant == Some(capture) {
-                    pawn_moves.push(Move { from: square, to: capture, move_type: MoveType::EnPassant });
-                }
+            // Captures
+            let captures = PAWN_ATTACKS[board.side_to_move.idx()][square.idx()];
+            for capture in captures & board.colors[(!board.side_to_move).idx()] {
+                push(capture, MoveType::Basic);
             }
-            // Capture right
-            if let Some(capture) = PAWN_RIGHT_CAPTURES[board.side_to_move.idx()][square.idx()] {
-                if board.colors[(!board.side_to_move).idx()] & Bitboard::from_square(capture) != Bitboard::EMPTY {
-                    pawn_moves.push(Move { from: square, to: capture, move_type: MoveType::Basic });
-                }
-                else if board.en_passant == Some(capture) {
-                    pawn_moves.push(Move { from: square, to: capture, move_type: MoveType::EnPassant });
+            if let Some(ep) = board.en_passant {
+                if captures & Bitboard::from_square(ep) != Bitboard::EMPTY {
+                    push(ep, MoveType::EnPassant);
                 }
             }
-
-            // If on promotion rank, convert moves into promotions
-            if square.rank() == match board.side_to_move {
-                Color::White => Rank::Seven,
-                Color::Black => Rank::Two
-            } {
-                v.extend(pawn_moves.into_iter().flat_map(|mv| Move::promotions(mv.from, mv.to)));
-            } else {
-                v.extend(pawn_moves);
-            }
         }
     }
 }
 
-fn gen_attacks(board: &Board, color: Color, blockers: Bitboard) -> Bitboard {
-    let mut attacks = Bitboard::EMPTY;
-    for piece in PIECES {
-        for square in board.pieces[piece.idx()] & board.colors[color.idx()] {
-            attacks |= gen_piece_attacks(piece, color, square, blockers);
-        }
+fn is_attacked(board: &Board, square: Square, color: Color, blockers: Bitboard) -> bool {
+    // Check if `color` attacks `square` by looking outward from the square for each kind of attacker,
+    // stopping at the first one found
+    let attackers = board.colors[color.idx()];
+
+    if KNIGHT_MOVES[square.idx()] & board.pieces[Piece::Knight.idx()] & attackers != Bitboard::EMPTY {
+        return true;
     }
-    attacks
-}
 
-fn gen_piece_attacks(piece: Piece, color: Color, square: Square, blockers: Bitboard) -> Bitboard {
-    match piece {
-        Piece::Rook => magic_tables::get_rook_moves(square, blockers),
-        Piece::Knight => KNIGHT_MOVES[square.idx()],
-        Piece::Bishop => magic_tables::get_bishop_moves(square, blockers),
-        Piece::Queen => magic_tables::get_queen_moves(square, blockers),
-        Piece::King => KING_MOVES[square.idx()],
-        Piece::Pawn => {
-            (match square.forward(color).unwrap().left() {
-                Some(square) => Bitboard::from_square(square),
-                None => Bitboard::EMPTY
-            }) | match square.forward(color).unwrap().right() {
-                Some(square) => Bitboard::from_square(square),
-                None => Bitboard::EMPTY
-            }
-        }
+    // A pawn of `color` attacks `square` if a pawn of the other color on `square` would attack it back
+    if PAWN_ATTACKS[(!color).idx()][square.idx()] & board.pieces[Piece::Pawn.idx()] & attackers != Bitboard::EMPTY {
+        return true;
+    }
+
+    let queens = board.pieces[Piece::Queen.idx()];
+    if magic_tables::get_rook_moves(square, blockers) & (board.pieces[Piece::Rook.idx()] | queens) & attackers != Bitboard::EMPTY {
+        return true;
+    }
+    if magic_tables::get_bishop_moves(square, blockers) & (board.pieces[Piece::Bishop.idx()] | queens) & attackers != Bitboard::EMPTY {
+        return true;
     }
+
+    KING_MOVES[square.idx()] & board.pieces[Piece::King.idx()] & attackers != Bitboard::EMPTY
 }
 
 const KNIGHT_MOVES: [Bitboard; NUM_SQUARES] = {
@@ -664,36 +819,90 @@ const KING_MOVES: [Bitboard; NUM_SQUARES] = {
     king_moves
 };
 
-const PAWN_LEFT_CAPTURES: [[Option<Square>; NUM_SQUARES]; NUM_COLORS] = {
-    let mut captures = [[None; NUM_SQUARES]; NUM_COLORS];
+const PAWN_ATTACKS: [[Bitboard; NUM_SQUARES]; NUM_COLORS] = {
+    // Also filled in for the back ranks, so the table can be used to look for pawns attacking a square
+    let mut pawn_attacks = [[Bitboard::EMPTY; NUM_SQUARES]; NUM_COLORS];
     let mut square_idx = 0;
     while square_idx < NUM_SQUARES {
         let square = Square::from_idx(square_idx);
-        match square.rank() {
-            Rank::One | Rank::Eight => { square_idx += 1; continue },
-            _ => ()
-        };
 
-        captures[Color::White.idx()][square_idx] = square.up().unwrap().left();
-        captures[Color::Black.idx()][square_idx] = square.down().unwrap().left();
+        if let Some(step) = square.up() {
+            if let Some(sq) = step.left() {
+                pawn_attacks[Color::White.idx()][square_idx].0 |= Bitboard::from_square(sq).0;
+            }
+            if let Some(sq) = step.right() {
+                pawn_attacks[Color::White.idx()][square_idx].0 |= Bitboard::from_square(sq).0;
+            }
+        }
+        if let Some(step) = square.down() {
+            if let Some(sq) = step.left() {
+                pawn_attacks[Color::Black.idx()][square_idx].0 |= Bitboard::from_square(sq).0;
+            }
+            if let Some(sq) = step.right() {
+                pawn_attacks[Color::Black.idx()][square_idx].0 |= Bitboard::from_square(sq).0;
+            }
+        }
+
         square_idx += 1;
     }
-    captures
+    pawn_attacks
 };
 
-const PAWN_RIGHT_CAPTURES: [[Option<Square>; NUM_SQUARES]; NUM_COLORS] = {
-    let mut captures = [[None; NUM_SQUARES]; NUM_COLORS];
-    let mut square_idx = 0;
-    while square_idx < NUM_SQUARES {
-        let square = Square::from_idx(square_idx);
-        match square.rank() {
-            Rank::One | Rank::Eight => { square_idx += 1; continue },
-            _ => ()
-        };
+#[cfg(test)]
+mod tests {
+    use super::*;
+    use pretty_assertions::assert_eq;
 
-        captures[Color::White.idx()][square_idx] = square.up().unwrap().right();
-        captures[Color::Black.idx()][square_idx] = square.down().unwrap().right();
-        square_idx += 1;
+    fn check_consistency(board: &Board) {
+        for idx in 0..NUM_SQUARES {
+            let square = Bitboard::from_square(Square::from_idx(idx));
+            let piece = PIECES.into_iter().find(|piece| board.pieces[piece.idx()] & square != Bitboard::EMPTY);
+            assert_eq!(board.mailbox[idx], piece, "mailbox doesn't match bitboards on {:?}", Square::from_idx(idx));
+        }
+        assert_eq!(board.hash, ZOBRIST_HASHER.hash(board));
+    }
+
+    fn perft(board: &mut Board, depth: usize) -> usize {
+        // Count the positions `depth` plies from `board`, checking the board's redundant state at every node on the way
+        check_consistency(board);
+
+        let mut moves = Vec::new();
+        gen_legal_moves(board, &mut moves);
+        assert_eq!(has_legal_moves(board), !moves.is_empty());
+        assert_eq!(board.is_checkmate(), moves.is_empty() && board.is_check());
+
+        if depth == 0 {
+            return 1;
+        }
+
+        let mut count = 0;
+        for mv in moves {
+            let (pieces, colors, mailbox, hash) = (board.pieces, board.colors, board.mailbox, board.hash);
+            let undoer = board.make(mv);
+            count += perft(board, depth - 1);
+            board.unmake(undoer);
+            assert!(board.pieces == pieces && board.colors == colors && board.mailbox == mailbox && board.hash == hash,
+                "unmaking {} didn't restore the board", mv);
+        }
+        count
+    }
+
+    #[test]
+    fn perft_standard_positions() {
+        // https://www.chessprogramming.org/Perft_Results
+        const POSITIONS: [(&str, usize, usize); 6] = [
+            (START_POS_FEN, 3, 8902),
+            ("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1", 3, 97862),
+            ("8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1", 4, 43238),
+            ("r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1", 3, 9467),
+            ("rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8", 3, 62379),
+            ("r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10", 2, 2079),
+        ];
+
+        magic_tables::init_magic_tables();
+        for (fen, depth, expected) in POSITIONS {
+            let mut board = Board::new(fen).unwrap();
+            assert_eq!(perft(&mut board, depth), expected, "perft({}) of {}", depth, fen);
+        }
     }
-    captures
-};
\ No newline at end of file
+}
\ No newline at end of file
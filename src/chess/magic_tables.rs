@@ -3,20 +3,17 @@ use super::{bitboard::Bitboard, square::{Square, NUM_SQUARES}};
 use std::sync::OnceLock;
 
 use rand::{RngCore, SeedableRng, rngs::SmallRng};
-use crate::prng::PRNG;
 
 // https://analog-hors.github.io/site/magic-bitboards/
 
 #[inline]
 pub fn get_rook_moves(square: Square, blockers: Bitboard) -> Bitboard {
-    let entry = &ROOK_MAGICS.get().unwrap()[square.idx()];
-    entry.1[magic_table_idx(&entry.0, blockers)]
+    ROOK_MAGICS.get().unwrap().get(square, blockers)
 }
 
 #[inline]
 pub fn get_bishop_moves(square: Square, blockers: Bitboard) -> Bitboard {
-    let entry = &BISHOP_MAGICS.get().unwrap()[square.idx()];
-    entry.1[magic_table_idx(&entry.0, blockers)]
+    BISHOP_MAGICS.get().unwrap().get(square, blockers)
 }
 
 #[inline]
@@ -24,118 +21,96 @@ pub fn get_queen_moves(square: Square, blockers: Bitboard) -> Bitboard {
     get_rook_moves(square, blockers) | get_bishop_moves(square, blockers)
 }
 
-static ROOK_MAGICS: OnceLock<[(Magic, Vec<Bitboard>); NUM_SQUARES]> = OnceLock::new();
-static BISHOP_MAGICS: OnceLock<[(Magic, Vec<Bitboard>); NUM_SQUARES]> = OnceLock::new();
+static ROOK_MAGICS: OnceLock<MagicTable> = OnceLock::new();
+static BISHOP_MAGICS: OnceLock<MagicTable> = OnceLock::new();
 
 pub fn init_magic_tables() {
-    ROOK_MAGICS.set({
-        let mut magics = core::array::from_fn(|_|
-            (Magic {
-                mask: Bitboard::EMPTY,
-                mult: 0,
-                idx_bits: 0
-            },
-            Vec::with_capacity(1 << ROOK_IDX_BITS))
-        );
-
-        // TODO: improve my PRNG so this isn't needed
-        let mut rng = SmallRng::seed_from_u64(123123);
-
-        let mut square_idx = 0;
-        while square_idx < NUM_SQUARES {
-            let square = Square::from_idx(square_idx);
-            let mask = ROOK_MASKS[square_idx];
-
-            'search: loop {
-                let mult = rng.next_u64() & rng.next_u64() & rng.next_u64(); 
-                let magic = Magic { mask, mult, idx_bits: 64 - ROOK_IDX_BITS };
-
-                let mut moves_table = vec![Bitboard::EMPTY; 1 << ROOK_IDX_BITS];
-
-                let mut blockers = Bitboard::EMPTY;
-                loop {
-                    let moves = rook_moves(square, blockers);
-
-                    // Check if entry matches, or write entry to table
-                    let entry = &mut moves_table[magic_table_idx(&magic, blockers)];
-                    if entry.0 == Bitboard::EMPTY.0 {
-                        *entry = moves;
-                    } else if entry.0 != moves.0 {
-                        continue 'search;
-                    }
-
-                    // Move to next subset
-                    blockers.0 = blockers.0.wrapping_sub(mask.0) & mask.0;
-                    if blockers.0 == Bitboard::EMPTY.0 {
-                        break;
-                    }
-                }
+    // TODO: improve my PRNG so this isn't needed
+    let mut rng = SmallRng::seed_from_u64(123123);
+
+    ROOK_MAGICS.set(find_magics(&ROOK_MASKS, rook_moves, &mut rng))
+        .map_err(|_| ()).expect("error initializing rook magics");
+    BISHOP_MAGICS.set(find_magics(&BISHOP_MASKS, bishop_moves, &mut rng))
+        .map_err(|_| ()).expect("error initializing bishop magics");
+}
+
+fn find_magics(masks: &[Bitboard; NUM_SQUARES], gen_moves: fn(Square, Bitboard) -> Bitboard, rng: &mut SmallRng) -> MagicTable {
+    // Each square gets exactly as many index bits as its mask has squares ("fancy" magics),
+    // and all of the squares' tables are packed into one shared vec
+    let mut magics = [Magic { mask: Bitboard::EMPTY, mult: 0, idx_bits: 0, offset: 0 }; NUM_SQUARES];
+    let mut moves = Vec::new();
 
-                magics[square_idx] = (magic, moves_table);
-                square_idx += 1;
+    for square_idx in 0..NUM_SQUARES {
+        let square = Square::from_idx(square_idx);
+        let mask = masks[square_idx];
+        let table_bits = mask.0.count_ones() as u8;
+
+        // Every subset of the mask, paired with the moves it allows
+        let mut subsets = Vec::with_capacity(1 << table_bits);
+        let mut blockers = Bitboard::EMPTY;
+        loop {
+            subsets.push((blockers, gen_moves(square, blockers)));
+
+            // Move to next subset
+            blockers.0 = blockers.0.wrapping_sub(mask.0) & mask.0;
+            if blockers == Bitboard::EMPTY {
                 break;
             }
         }
 
-        magics
-    }).map_err(|_| ()).expect("error initializing rook magics");
-    BISHOP_MAGICS.set({
-        let mut magics = core::array::from_fn(|_|
-            (Magic {
-                mask: Bitboard::EMPTY,
-                mult: 0,
-                idx_bits: 0
-            },
-            Vec::with_capacity(1 << BISHOP_IDX_BITS))
-        );
-
-        let mut square_idx = 0;
-        while square_idx < NUM_SQUARES {
-            let square = Square::from_idx(square_idx);
-            let mask = BISHOP_MASKS[square_idx];
-
-            let mut prng = PRNG::new(123123);
-
-            'search: loop {
-                let mult = prng.next() & prng.next() & prng.next();
-                let magic = Magic { mask, mult, idx_bits: 64 - BISHOP_IDX_BITS };
-
-                let mut moves_table = vec![Bitboard::EMPTY; 1 << BISHOP_IDX_BITS];
-
-                let mut blockers = Bitboard::EMPTY;
-                loop {
-                    let moves = bishop_moves(square, blockers);
-
-                    // Check if entry matches, or write entry to table
-                    let entry = &mut moves_table[magic_table_idx(&magic, blockers)];
-                    if entry.0 == Bitboard::EMPTY.0 {
-                        *entry = moves;
-                    } else if entry.0 != moves.0 {
-                        continue 'search;
-                    }
-
-                    // Move to next subset
-                    blockers.0 = blockers.0.wrapping_sub(mask.0) & mask.0;
-                    if blockers.0 == Bitboard::EMPTY.0 {
-                        break;
-                    }
-                }
+        let mut moves_table = vec![Bitboard::EMPTY; 1 << table_bits];
+        // The attempt that last wrote each entry, so the table doesn't need clearing between attempts
+        let mut written_by = vec![0; 1 << table_bits];
+        let mut attempt = 0;
 
-                magics[square_idx] = (magic, moves_table);
-                square_idx += 1;
-                break;
+        'search: loop {
+            let mult = rng.next_u64() & rng.next_u64() & rng.next_u64();
+            // Multipliers that don't spread the mask into the top bits can't make a good index
+            if (mask.0.wrapping_mul(mult) >> 56).count_ones() < 6 {
+                continue;
+            }
+            let magic = Magic { mask, mult, idx_bits: 64 - table_bits, offset: moves.len() };
+            attempt += 1;
+
+            for &(blockers, square_moves) in &subsets {
+                // Check if entry matches, or write entry to table
+                let idx = magic_table_idx(&magic, blockers);
+                if written_by[idx] != attempt {
+                    written_by[idx] = attempt;
+                    moves_table[idx] = square_moves;
+                } else if moves_table[idx] != square_moves {
+                    continue 'search;
+                }
             }
+
+            magics[square_idx] = magic;
+            moves.extend_from_slice(&moves_table);
+            break;
         }
+    }
+
+    MagicTable { magics, moves }
+}
 
-        magics
-    }).map_err(|_| ()).expect("error initializing bishop magics");
+struct MagicTable {
+    magics: [Magic; NUM_SQUARES],
+    moves: Vec<Bitboard>
+}
+
+impl MagicTable {
+    #[inline(always)]
+    fn get(&self, square: Square, blockers: Bitboard) -> Bitboard {
+        let magic = &self.magics[square.idx()];
+        self.moves[magic.offset + magic_table_idx(magic, blockers)]
+    }
 }
 
 #[derive(Debug, Clone, Copy)]
 struct Magic {
     mask: Bitboard,
     mult: u64,
-    idx_bits: u8
+    idx_bits: u8,
+    offset: usize
 }
 
 const fn magic_table_idx(magic: &Magic, blockers: Bitboard) -> usize {
@@ -145,8 +120,6 @@ const fn magic_table_idx(magic: &Magic, blockers: Bitboard) -> usize {
     idx
 }
 
-const ROOK_IDX_BITS: u8 = 12;
-
 const ROOK_MASKS: [Bitboard; NUM_SQUARES] = {
     let mut masks = [Bitboard::EMPTY; 64];
 
@@ -214,8 +187,6 @@ const ROOK_MASKS: [Bitboard; NUM_SQUARES] = {
     masks
 };
 
-const BISHOP_IDX_BITS: u8 = 9;
-
 const BISHOP_MASKS: [Bitboard; NUM_SQUARES] = {
     let mut masks = [Bitboard::EMPTY; 64];
 
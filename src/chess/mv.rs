@@ -30,8 +30,8 @@ impl Move {
 
         let move_type = match board.get_piece_at(from)? {
             Piece::Pawn => {
-                if let Some(ep) = board.get_en_passant() {
-                    if to == ep { MoveType::EnPassant } else { MoveType::Basic }
+                if board.get_en_passant() == Some(to) {
+                    MoveType::EnPassant
                 }
                 else if to.rank() == Rank::One || to.rank() == Rank::Eight {
                     MoveType::Promotion(Piece::from_ascii(uci.bytes().nth(4)?)?)
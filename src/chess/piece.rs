@@ -1,3 +1,4 @@
+#[repr(u8)]
 #[derive(Debug, Clone, Copy, PartialEq, Eq, Hash)]
 pub enum Piece {
     Rook,
@@ -16,15 +17,7 @@ pub const PIECES: [Piece; NUM_PIECES] = [
 impl Piece {
     #[inline]
     pub const fn from_idx(idx: usize) -> Self {
-        match idx {
-            0 => Piece::Rook,
-            1 => Piece::Knight,
-            2 => Piece::Bishop,
-            3 => Piece::Queen,
-            4 => Piece::King,
-            5 => Piece::Pawn,
-            _ => panic!("invalid idx")
-        }
+        PIECES[idx]
     }
 
     #[inline]
@@ -182,51 +182,41 @@ impl Square {
         self.0 as usize
     }
 
+    // Steps work directly on the square index: one compare for the board edge, then an add or subtract
+
     #[inline]
     pub const fn up(&self) -> Option<Self> {
-        match self.rank().up() {
-            Some(rank) => Some(Self::from_coords(self.file(), rank)),
-            None => None
-        }
+        if self.0 >= 56 { None } else { Some(Self(self.0 + 8)) }
     }
 
     #[inline]
     pub const fn down(&self) -> Option<Self> {
-        match self.rank().down() {
-            Some(rank) => Some(Self::from_coords(self.file(), rank)),
-            None => None
-        }
+        if self.0 < 8 { None } else { Some(Self(self.0 - 8)) }
     }
 
     #[inline]
     pub const fn left(&self) -> Option<Self> {
-        match self.file().left() {
-            Some(file) => Some(Self::from_coords(file, self.rank())),
-            None => None
-        }
+        if self.0 & 7 == 0 { None } else { Some(Self(self.0 - 1)) }
     }
 
     #[inline]
     pub const fn right(&self) -> Option<Self> {
-        match self.file().right() {
-            Some(file) => Some(Self::from_coords(file, self.rank())),
-            None => None
-        }
+        if self.0 & 7 == 7 { None } else { Some(Self(self.0 + 1)) }
     }
 
     #[inline]
     pub const fn forward(&self, color: Color) -> Option<Self> {
-        match self.rank().forward(color) {
-            Some(rank) => Some(Self::from_coords(self.file(), rank)),
-            None => None
+        match color {
+            Color::White => self.up(),
+            Color::Black => self.down()
         }
     }
 
     #[inline]
     pub const fn backward(&self, color: Color) -> Option<Self> {
-        match self.rank().backward(color) {
-            Some(rank) => Some(Self::from_coords(self.file(), rank)),
-            None => None
+        match color {
+            Color::White => self.down(),
+            Color::Black => self.up()
         }
     }
 
@@ -1,12 +1,27 @@
-use crate::chess::{Board, Color, Move, Piece, PIECES, gen_legal_moves, make_move};
+use crate::chess::{Board, Color, Move, MoveType, Piece, NUM_PIECES, PIECES, gen_legal_moves};
 use crate::uci::{HaltCommand, UciGoOptions, UciResponse};
 
-use std::{collections::HashMap, sync::mpsc, time::Instant};
+use std::{sync::{atomic::{AtomicBool, AtomicIsize, AtomicUsize, Ordering}, mpsc}, thread, time::{Duration, Instant}};
 
 mod psts;
+mod tt;
+
+use tt::{Bound, TtEntry};
+pub use tt::TranspositionTable;
 
 const MAX_DEPTH: usize = 6;
 const MAX_TIME: usize = usize::MAX; // ms
+// How often the root checks for a `HaltCommand` while search threads are running
+const HALT_POLL_INTERVAL: Duration = Duration::from_millis(1);
+
+// The UCI `Threads` option goes up to `MAX_THREADS`. By default, every core is used, up to `MAX_DEFAULT_THREADS`
+pub const MAX_THREADS: usize = 64;
+const MAX_DEFAULT_THREADS: usize = 8;
+
+// Getting checkmated `ply` plies from the root scores `-(MATE_SCORE - ply)`, so quicker mates score better.
+// Any score past `MATE_BOUND` is a forced mate. Scores have to fit in 32 bits to be stored in the transposition table
+const MATE_SCORE: isize = i32::MAX as isize / 2;
+const MATE_BOUND: isize = MATE_SCORE - 1000;
 
 const fn next_iter_time_guess(depth: usize) -> usize {
     match depth {
@@ -71,32 +86,58 @@ pub fn decide_options(board: &mut Board, go_options: &UciGoOptions) -> SearchOpt
     }
 }
 
-pub fn search_perft(board: &Board, depth: usize, info_sender: Option<&mpsc::Sender<UciResponse>>) -> usize {
+pub fn search_perft(board: &Board, depth: usize, threads: usize, info_sender: Option<&mpsc::Sender<UciResponse>>) -> usize {
+    // Count the positions `depth` plies from `board`. Root moves' subtrees are independent, so they're shared out between `threads` threads,
+    // each taking the next unclaimed move when it finishes one.
+    // If `info_sender` is `Some(tx)`, each root move's count is sent once they're all done, in the order the moves were generated.
     if depth == 0 { return 1; }
 
-    let mut count = 0;
+    let mut moves = Vec::new();
+    gen_legal_moves(board, &mut moves);
 
-    if let Some(info_sender) = info_sender {
-        let mut moves = Vec::new();
-        gen_legal_moves(board, &mut moves);
+    let next_move = AtomicUsize::new(0);
+    let mut subtotals = vec![0; moves.len()];
 
-        for mv in moves {
-            let mut subtotal = 0;
-            perft(&make_move(board, mv), &mut subtotal, depth - 1);
+    thread::scope(|scope| {
+        let workers: Vec<_> = (0..threads.min(moves.len())).map(|_| scope.spawn(|| {
+            let mut board = *board;
+            let mut subtotals = Vec::new();
 
-            info_sender.send(UciResponse::Plaintext(format!("{}: {}", mv.uci(), subtotal))).expect("stdout error");
+            loop {
+                let i = next_move.fetch_add(1, Ordering::Relaxed);
+                let Some(&mv) = moves.get(i) else { break; };
+
+                let mut subtotal = 0;
+                let undoer = board.make(mv);
+                perft(&mut board, &mut subtotal, depth - 1);
+                board.unmake(undoer);
+
+                subtotals.push((i, subtotal));
+            }
+            subtotals
+        })).collect();
 
-            count += subtotal;
+        for worker in workers {
+            for (i, subtotal) in worker.join().expect("perft thread panicked") {
+                subtotals[i] = subtotal;
+            }
+        }
+    });
+
+    if let Some(info_sender) = info_sender {
+        for (mv, subtotal) in moves.iter().zip(&subtotals) {
+            info_sender.send(UciResponse::Plaintext(format!("{}: {}", mv.uci(), subtotal))).expect("stdout error");
         }
     }
-    else {
-        perft(board, &mut count, depth)
-    }
 
-    count
+    subtotals.iter().sum()
+}
+
+pub fn default_threads() -> usize {
+    thread::available_parallelism().map_or(1, |n| n.get()).min(MAX_DEFAULT_THREADS)
 }
 
-fn perft(board: &Board, count: &mut usize, depth: usize) {
+fn perft(board: &mut Board, count: &mut usize, depth: usize) {
     if depth == 0 {
         *count += 1;
         return;
@@ -111,11 +152,15 @@ fn perft(board: &Board, count: &mut usize, depth: usize) {
     }
 
     for mv in moves {
-        perft(&make_move(board, mv), count, depth - 1);
+        let undoer = board.make(mv);
+        perft(board, count, depth - 1);
+        board.unmake(undoer);
     }
 }
 
-pub fn search_infinite(board: &Board, search_moves: Option<Vec<Move>>, halt_receiver: &mpsc::Receiver<HaltCommand>) -> Result<Option<Move>, ()> {
+pub fn search_infinite(
+    board: &Board, search_moves: Option<Vec<Move>>, threads: usize, tt: &TranspositionTable, halt_receiver: &mpsc::Receiver<HaltCommand>
+) -> Result<Option<Move>, ()> {
     let mut moves = search_moves.unwrap_or_else(|| {
         let mut moves = Vec::new();
         gen_legal_moves(board, &mut moves);
@@ -134,7 +179,7 @@ pub fn search_infinite(board: &Board, search_moves: Option<Vec<Move>>, halt_rece
         }
 
         // Search
-        let result = dfs_search_and_sort(board, &mut moves, &mut best_move, depth, Some(halt_receiver));
+        let result = dfs_search_and_sort(board, &mut moves, &mut best_move, depth, threads, tt, Some(halt_receiver));
         // Check for a halt command while searching
         if let Err(halt_command) = result {
             match halt_command {
@@ -148,9 +193,11 @@ pub fn search_infinite(board: &Board, search_moves: Option<Vec<Move>>, halt_rece
 }
 
 pub fn search(
-    board: &Board, options: SearchOptions, search_moves: Option<Vec<Move>>, halt_receiver: Option<&mpsc::Receiver<HaltCommand>>
+    board: &Board, options: SearchOptions, search_moves: Option<Vec<Move>>, threads: usize, tt: &TranspositionTable,
+    halt_receiver: Option<&mpsc::Receiver<HaltCommand>>
 ) -> Result<Option<Move>, ()> {
     // Search for the best move in a position using [iterative deepening](https://www.chessprogramming.org/Iterative_Deepening)
+    // with `threads` threads sharing `tt`, which can be kept between searches.
     // If `halt_receiver` is `Some(rx)`, the search can end early if a `HaltCommand` is sent to the receiver. 
     let start_time = Instant::now();
 
@@ -181,10 +228,14 @@ pub fn search(
         }
 
         // Search
-        let result = dfs_search_and_sort(board, &mut moves, &mut best_move, depth, halt_receiver);
-        // Check for a halt command while searching
-        if let Err(halt_command) = result {
-            match halt_command {
+        let result = dfs_search_and_sort(board, &mut moves, &mut best_move, depth, threads, tt, halt_receiver);
+        match result {
+            // Iterative deepening finds the shortest forced mate first, so there's no need to look deeper
+            Ok(best_score) => if best_score >= MATE_BOUND {
+                return Ok(best_move);
+            },
+            // Check for a halt command while searching
+            Err(halt_command) => match halt_command {
                 HaltCommand::Stop => return Ok(best_move),
                 HaltCommand::Quit => return Err(())
             }
@@ -206,7 +257,7 @@ pub fn search(
     }
 
     // Final search
-    let result = dfs_search_final(board, &mut moves, &mut best_move, max_depth, halt_receiver);
+    let result = dfs_search_final(board, &mut moves, &mut best_move, max_depth, threads, tt, halt_receiver);
     // Check for a halt command while searching
     if let Err(halt_command) = result {
         match halt_command {
@@ -219,104 +270,185 @@ pub fn search(
 }
 
 fn dfs_search_and_sort(
-    board: &Board, moves: &mut Vec<Move>, best_move: &mut Option<Move>, depth: usize, halt_receiver: Option<&mpsc::Receiver<HaltCommand>>
-) -> Result<(), HaltCommand> {
-    // Run depth-first search with a max depth of `depth` and sort `moves` from worst to best.
-    // The function also updates `best_move` as soon as a better move is discovered; combined with move-sorting from previous iterations,
+    board: &Board, moves: &mut Vec<Move>, best_move: &mut Option<Move>, depth: usize,
+    threads: usize, tt: &TranspositionTable, halt_receiver: Option<&mpsc::Receiver<HaltCommand>>
+) -> Result<isize, HaltCommand> {
+    // Run depth-first search with a max depth of `depth`, sort `moves` from best to worst, and return the best score.
+    // The function also updates `best_move`, even if the search is halted partway; combined with move-sorting from previous iterations,
     // this means that `best_move` will have a reasonable move at any sufficiently late point in the search function.
-    // Alpha-beta pruning isn't used when iterating over `moves` because in order to sort the moves accurately, each move's score must be fully calculated.
-    let mut best_score = -isize::MAX;
-
-    let mut scores = HashMap::new();
-    for mv in moves.iter().cloned() {
-        // Check for a halt command
-        if let Some(halt_receiver) = halt_receiver {
-            if let Ok(halt_command) = halt_receiver.try_recv() { return Err(halt_command); }
-        }
-
-        let score = -negamax(
-            &make_move(board, mv), depth - 1, -isize::MAX, isize::MAX, halt_receiver
-        )?;
+    // Alpha-beta pruning isn't used between root moves because in order to sort the moves accurately, each move's score must be fully calculated.
+    let (scores, halt) = search_root(board, moves, depth, false, threads, tt, halt_receiver);
 
-        if score > best_score {
-            best_score = score;
-            *best_move = Some(mv.clone());
-        }
+    // The sort is stable, so ties keep their order from the previous iteration
+    let previous_best_done = scores.first().is_some_and(|score| score.is_some());
+    let mut scored_moves: Vec<_> = moves.iter().zip(scores).filter_map(|(&mv, score)| Some((mv, score?))).collect();
+    scored_moves.sort_by_key(|&(_, score)| -score);
 
-        scores.insert(mv, score);
+    update_best_move(best_move, scored_moves.first().map(|&(mv, _)| mv), previous_best_done);
+    if let Some(halt_command) = halt {
+        return Err(halt_command);
     }
 
-    // Check for a halt command
-    if let Some(halt_receiver) = halt_receiver {
-        if let Ok(halt_command) = halt_receiver.try_recv() { return Err(halt_command); }
-    }
+    let best_score = scored_moves.first().map_or(-isize::MAX, |&(_, score)| score);
+    moves.clear();
+    moves.extend(scored_moves.into_iter().map(|(mv, _)| mv));
 
-    moves.sort_by_key(|mv| -scores.get(mv).unwrap());
-
-    Ok(())
+    Ok(best_score)
 }
 
 fn dfs_search_final(
-    board: &Board, moves: &mut Vec<Move>, best_move: &mut Option<Move>, max_depth: usize, halt_receiver: Option<&mpsc::Receiver<HaltCommand>>
+    board: &Board, moves: &mut Vec<Move>, best_move: &mut Option<Move>, max_depth: usize,
+    threads: usize, tt: &TranspositionTable, halt_receiver: Option<&mpsc::Receiver<HaltCommand>>
 ) -> Result<(), HaltCommand> {
     // Run depth-first search with a max depth of `depth`, utilizing alpha-beta pruning on the provided moves to maximize speed.
-    let mut best_score = -isize::MAX;
-    let mut alpha = -isize::MAX;
+    let (scores, halt) = search_root(board, moves, max_depth, true, threads, tt, halt_receiver);
 
-    for &mut mv in moves {
-        // Check for a halt command
-        if let Some(halt_receiver) = halt_receiver {
-            if let Ok(halt_command) = halt_receiver.try_recv() { return Err(halt_command); }
+    // Ties go to the earlier move, which scored better in the previous iteration
+    let previous_best_done = scores.first().is_some_and(|score| score.is_some());
+    let best = moves.iter().zip(scores).filter_map(|(&mv, score)| Some((mv, score?)))
+        .reduce(|best, next| if next.1 > best.1 { next } else { best });
+
+    update_best_move(best_move, best.map(|(mv, _)| mv), previous_best_done);
+    match halt {
+        Some(halt_command) => Err(halt_command),
+        None => Ok(())
+    }
+}
+
+#[inline]
+fn update_best_move(best_move: &mut Option<Move>, found: Option<Move>, previous_best_done: bool) {
+    // Moves are searched in order, so until the previous iteration's best move has been rescored,
+    // the moves finished so far can't be trusted to beat it
+    if let Some(found) = found {
+        if previous_best_done || best_move.is_none() {
+            *best_move = Some(found);
         }
+    }
+}
 
-        let score = -negamax(
-            &make_move(board, mv), max_depth - 1, -isize::MAX, -alpha, halt_receiver
-        )?;
+fn search_root(
+    board: &Board, moves: &[Move], depth: usize, prune: bool,
+    threads: usize, tt: &TranspositionTable, halt_receiver: Option<&mpsc::Receiver<HaltCommand>>
+) -> (Vec<Option<isize>>, Option<HaltCommand>) {
+    // Score each of `moves` by searching it to `depth`. The moves are shared out between `threads` threads,
+    // each taking the next unclaimed move when it finishes one, while this thread waits for a `HaltCommand` and tells the others to stop.
+    // If `prune`, the best score so far is shared between threads as alpha, and a move that can't beat it scores `-isize::MAX`.
+    // Returns the score of each move, or `None` if it wasn't finished before a halt, along with the halt command
+    let next_move = AtomicUsize::new(0);
+    let alpha = AtomicIsize::new(-isize::MAX);
+    let stop = AtomicBool::new(false);
+    let num_workers = threads.min(moves.len());
+    let running = AtomicUsize::new(num_workers);
+    let root_thread = thread::current();
+
+    thread::scope(|scope| {
+        let workers: Vec<_> = (0..num_workers).map(|_| {
+            let (next_move, alpha, stop, running, root_thread) = (&next_move, &alpha, &stop, &running, &root_thread);
+            scope.spawn(move || {
+                let mut board = *board;
+                let mut scores = Vec::new();
+
+                loop {
+                    let i = next_move.fetch_add(1, Ordering::Relaxed);
+                    let Some(&mv) = moves.get(i) else { break; };
+
+                    let move_alpha = alpha.load(Ordering::Relaxed);
+                    let undoer = board.make(mv);
+                    let Ok(score) = negamax(&mut board, depth - 1, 1, -isize::MAX, -move_alpha, tt, stop) else { break; };
+                    let score = -score;
+                    board.unmake(undoer);
+
+                    // A score at or below alpha is only an upper bound
+                    if score > move_alpha {
+                        if prune {
+                            alpha.fetch_max(score, Ordering::Relaxed);
+                        }
+                        scores.push((i, score));
+                    } else {
+                        scores.push((i, -isize::MAX));
+                    }
+                }
 
-        if score > best_score {
-            best_score = score;
-            *best_move = Some(mv.clone());
+                running.fetch_sub(1, Ordering::Release);
+                root_thread.unpark();
+                scores
+            })
+        }).collect();
 
-            if score > alpha {
-                alpha = score;
-                if score == isize::MAX {
-                    // checkmate! dubious actually...
-                    return Ok(());
+        let mut halt = None;
+        if let Some(halt_receiver) = halt_receiver {
+            while running.load(Ordering::Acquire) > 0 {
+                if let Ok(halt_command) = halt_receiver.try_recv() {
+                    stop.store(true, Ordering::Relaxed);
+                    halt = Some(halt_command);
+                    break;
                 }
+                thread::park_timeout(HALT_POLL_INTERVAL);
             }
         }
-    }
-    Ok(())
+
+        let mut scores = vec![None; moves.len()];
+        for worker in workers {
+            for (i, score) in worker.join().expect("search thread panicked") {
+                scores[i] = Some(score);
+            }
+        }
+        (scores, halt)
+    })
 }
 
 fn negamax(
-    board: &Board, depth: usize, mut alpha: isize, beta: isize, halt_receiver: Option<&mpsc::Receiver<HaltCommand>>
-) -> Result<isize, HaltCommand> {
+    board: &mut Board, depth: usize, ply: usize, mut alpha: isize, beta: isize,
+    tt: &TranspositionTable, stop: &AtomicBool
+) -> Result<isize, ()> {
     // Recursively find the a position's score using [negamax](https://www.chessprogramming.org/Negamax)
     if depth == 0 {
+        if board.is_checkmate() {
+            return Ok(-(MATE_SCORE - ply as isize));
+        }
         return Ok(relative_score(board));
     }
 
+    // Reuse the result of an earlier search of this position if it was at least as deep and fits the window
+    let hash = board.get_hash();
+    if let Some(entry) = tt.get(hash) {
+        let score = score_from_tt(entry.score, ply);
+        if entry.depth >= depth && match entry.bound {
+            Bound::Exact => true,
+            Bound::Lower => score >= beta,
+            Bound::Upper => score <= alpha
+        } {
+            return Ok(score);
+        }
+    }
+    let original_alpha = alpha;
+
     let mut moves = Vec::new();
     gen_legal_moves(board, &mut moves);
     if moves.len() == 0 {
         return Ok(if board.is_check() {
-            -isize::MAX
+            -(MATE_SCORE - ply as isize)
         } else {
             0
         });
     }
 
+    // Try captures first, biggest victim and then smallest attacker first ([MVV-LVA](https://www.chessprogramming.org/MVV-LVA)),
+    // so cutoffs come sooner
+    moves.sort_by_key(|&mv| -mvv_lva(board, mv));
+
     let mut max = -isize::MAX;
     for mv in moves {
-        // Check for a halt command
-        if let Some(halt_receiver) = halt_receiver {
-            if let Ok(halt_command) = halt_receiver.try_recv() { return Err(halt_command); }
+        // Check if the search has been halted
+        if stop.load(Ordering::Relaxed) {
+            return Err(());
         }
 
+        let undoer = board.make(mv);
         let score = -negamax(
-            &make_move(board, mv), depth - 1, -beta, -alpha, halt_receiver
+            board, depth - 1, ply + 1, -beta, -alpha, tt, stop
         )?;
+        board.unmake(undoer);
 
         if score > max {
             max = score;
@@ -328,37 +460,89 @@ fn negamax(
             }
         }
     }
+
+    let bound = if max <= original_alpha {
+        Bound::Upper
+    } else if max >= beta {
+        Bound::Lower
+    } else {
+        Bound::Exact
+    };
+    tt.insert(TtEntry { hash, depth, score: score_to_tt(max, ply), bound });
+
     Ok(max)
 }
 
+#[inline]
+fn mvv_lva(board: &Board, mv: Move) -> isize {
+    // Every capture of a piece sorts before any capture of a cheaper one, and among those the cheapest attacker goes first.
+    // A promotion counts as capturing the material it gains. Quiet moves score 0
+    let victim = match mv.move_type {
+        MoveType::EnPassant => material(Piece::Pawn),
+        _ => board.get_piece_at(mv.to).map_or(0, material)
+    };
+    let promotion = match mv.move_type {
+        MoveType::Promotion(piece) => material(piece) - material(Piece::Pawn),
+        _ => 0
+    };
+
+    let gain = victim + promotion;
+    if gain == 0 {
+        return 0;
+    }
+    MVV_FACTOR * gain - ATTACKER_VALUE[board.get_piece_at(mv.from).unwrap().idx()]
+}
+
+// Indexed by `Piece::idx`. Unlike `MATERIAL`, the king is the most valuable attacker, so it captures last
+const ATTACKER_VALUE: [isize; NUM_PIECES] = [5, 3, 3, 9, 10, 1];
+// Larger than any attacker value, so the victim always decides first
+const MVV_FACTOR: isize = 16;
+
+// Mate scores count plies from the root, but the table is shared between plies,
+// so they're stored counting from the position itself
+
+#[inline]
+const fn score_to_tt(score: isize, ply: usize) -> isize {
+    if score >= MATE_BOUND { score + ply as isize }
+    else if score <= -MATE_BOUND { score - ply as isize }
+    else { score }
+}
+
+#[inline]
+const fn score_from_tt(score: isize, ply: usize) -> isize {
+    if score >= MATE_BOUND { score - ply as isize }
+    else if score <= -MATE_BOUND { score + ply as isize }
+    else { score }
+}
+
 const MATERIAL_FACTOR: isize = 100;
 const PST_FACTOR: isize = 1;
 
 fn relative_score(board: &Board) -> isize {
-    score_side(board, board.get_side_to_move()) - score_side(board, !board.get_side_to_move())
-}
-
-fn score_side(board: &Board, color: Color) -> isize {
+    // Score both sides in a single pass over the piece bitboards
+    let us = board.get_side_to_move();
+    let own = board.get_color(us);
+    let opp = board.get_color(!us);
     let mut score = 0;
 
     for piece in PIECES {
-        let material = material(piece);
-        for square in board.get_piece(piece) & board.get_color(color) {
-            score += MATERIAL_FACTOR * material;
-            score += PST_FACTOR * psts::get_mg(piece, color, square);
+        let pieces = board.get_piece(piece);
+        let material = MATERIAL_FACTOR * material(piece);
+        for square in pieces & own {
+            score += material + PST_FACTOR * psts::get_mg(piece, us, square);
+        }
+        for square in pieces & opp {
+            score -= material + PST_FACTOR * psts::get_mg(piece, !us, square);
         }
     }
 
     score
 }
 
+// Indexed by `Piece::idx`: rook, knight, bishop, queen, king, pawn
+const MATERIAL: [isize; NUM_PIECES] = [5, 3, 3, 9, 0, 1];
+
+#[inline(always)]
 const fn material(piece: Piece) -> isize {
-    match piece {
-        Piece::Rook => 5,
-        Piece::Knight => 3,
-        Piece::Bishop => 3,
-        Piece::King => 0,
-        Piece::Queen => 9,
-        Piece::Pawn => 1
-    }
+    MATERIAL[piece.idx()]
 }
\ No newline at end of file
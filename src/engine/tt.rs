@@ -0,0 +1,89 @@
+// https://www.chessprogramming.org/Transposition_Table
+
+use std::sync::atomic::{AtomicU64, Ordering};
+
+#[derive(Debug, Clone, Copy, PartialEq)]
+pub enum Bound {
+    Exact,
+    Lower,
+    Upper
+}
+
+const BOUNDS: [Bound; 3] = [Bound::Exact, Bound::Lower, Bound::Upper];
+
+#[derive(Debug, Clone, Copy)]
+pub struct TtEntry {
+    pub hash: u64,
+    pub depth: usize,
+    pub score: isize,
+    pub bound: Bound
+}
+
+impl TtEntry {
+    // Everything but the hash is packed into 64 bits: the score in the low 32, then the depth and the bound
+    #[inline]
+    fn pack(&self) -> u64 {
+        debug_assert!(i32::try_from(self.score).is_ok(), "score {} doesn't fit in a table entry", self.score);
+        (self.score as i32 as u32 as u64) | (self.depth.min(u8::MAX as usize) as u64) << 32 | (self.bound as u64) << 40
+    }
+
+    #[inline]
+    fn unpack(hash: u64, data: u64) -> Self {
+        Self {
+            hash,
+            depth: (data >> 32) as u8 as usize,
+            score: data as u32 as i32 as isize,
+            bound: BOUNDS[(data >> 40) as usize & 3]
+        }
+    }
+}
+
+// The table is shared between search threads without locking ([lockless hashing](https://www.chessprogramming.org/Shared_Hash_Table#Lockless)):
+// each slot stores the hash xored with the data, so a slot torn by two threads writing at once fails the hash check instead of giving a bad entry
+struct Slot {
+    key: AtomicU64,
+    data: AtomicU64
+}
+
+pub struct TranspositionTable(Vec<Slot>);
+
+const TT_IDX_BITS: usize = 18;
+
+impl TranspositionTable {
+    pub fn new() -> Self {
+        Self((0..1 << TT_IDX_BITS).map(|_| Slot { key: AtomicU64::new(0), data: AtomicU64::new(0) }).collect())
+    }
+
+    #[inline(always)]
+    const fn idx(hash: u64) -> usize {
+        (hash & ((1 << TT_IDX_BITS) - 1)) as usize
+    }
+
+    #[inline]
+    pub fn get(&self, hash: u64) -> Option<TtEntry> {
+        // An empty slot reads as a depth 0 entry for hash 0, which never passes a probe's depth check
+        let slot = &self.0[Self::idx(hash)];
+        let data = slot.data.load(Ordering::Relaxed);
+        if slot.key.load(Ordering::Relaxed) ^ data == hash {
+            Some(TtEntry::unpack(hash, data))
+        } else {
+            None
+        }
+    }
+
+    #[inline]
+    pub fn insert(&self, entry: TtEntry) {
+        // Always replace; deeper entries are usually reached again through iterative deepening anyway
+        let slot = &self.0[Self::idx(entry.hash)];
+        let data = entry.pack();
+        slot.key.store(entry.hash ^ data, Ordering::Relaxed);
+        slot.data.store(data, Ordering::Relaxed);
+    }
+
+    pub fn clear(&self) {
+        for slot in &self.0 {
+            slot.key.store(0, Ordering::Relaxed);
+            slot.data.store(0, Ordering::Relaxed);
+        }
+    }
+}
\ No newline at end of file
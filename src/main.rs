@@ -56,7 +56,7 @@ fn best_move_of_input(options: SearchOptions) {
 
     let start = Instant::now();
 
-    let best_move = engine::search(&mut board, options, None, None).unwrap();
+    let best_move = engine::search(&mut board, options, None, engine::default_threads(), &engine::TranspositionTable::new(), None).unwrap();
 
     println!("Time: {:?}", start.elapsed());
 
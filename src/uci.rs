@@ -28,7 +28,7 @@ pub enum HaltCommand {
 
 #[derive(Debug, PartialEq)]
 enum UciOption {
-
+    Threads(usize),
 }
 
 #[derive(Debug, PartialEq)]
@@ -87,6 +87,7 @@ pub fn run_uci_mode() {
                 UciResponse::Uci => {
                     println!("id name ElleBot");
                     println!("id author Elle");
+                    println!("option name Threads type spin default {} min 1 max {}", engine::default_threads(), engine::MAX_THREADS);
                     println!("uciok");
                 },
                 UciResponse::IsReady => {
@@ -103,6 +104,9 @@ pub fn run_uci_mode() {
     });
 
     let mut board = Board::default();
+    let mut threads = engine::default_threads();
+    // Kept between searches, so a new search can reuse what earlier ones found
+    let tt = engine::TranspositionTable::new();
 
     for command in stdin_receiver {
         match command {
@@ -110,7 +114,9 @@ pub fn run_uci_mode() {
                 stdout_sender.send(UciResponse::Uci).expect("stdout error");
             },
             UciCommand::SetOption { option } => {
-                todo!()
+                match option {
+                    UciOption::Threads(num) => threads = num
+                }
             },
             UciCommand::Position { fen, moves } => {
                 board = match Board::new(&fen) {
@@ -124,7 +130,7 @@ pub fn run_uci_mode() {
                 // println!("debug: set position to {}", board.get_fen());
             },
             UciCommand::UciNewGame => {
-
+                tt.clear();
             },
             UciCommand::IsReady => {
                 stdout_sender.send(UciResponse::IsReady).expect("stdout error");
@@ -142,20 +148,20 @@ pub fn run_uci_mode() {
 
                 if options.infinite {
                     println!("debug: searching infinitely");
-                    let Ok(Some(best_move)) = engine::search_infinite(&mut board, search_moves, &halt_receiver) else { return; };
+                    let Ok(Some(best_move)) = engine::search_infinite(&mut board, search_moves, threads, &tt, &halt_receiver) else { return; };
                     stdout_sender.send(UciResponse::BestMove(best_move.uci())).expect("stdout error");
                 }
 
                 else if let Some(depth) = options.perft {
                     println!("debug: running perft test with depth {}", depth);
-                    let count = engine::search_perft(&board, depth, Some(&stdout_sender));
+                    let count = engine::search_perft(&board, depth, threads, Some(&stdout_sender));
                     stdout_sender.send(UciResponse::Plaintext(count.to_string())).expect("stdout error");
                 }
 
                 else {
                     let search_options = engine::decide_options(&mut board, &options);
                     println!("debug: decided search options {:?}", search_options);
-                    let Ok(Some(best_move)) = engine::search(&mut board, search_options, search_moves, Some(&halt_receiver)) else { return; };
+                    let Ok(Some(best_move)) = engine::search(&mut board, search_options, search_moves, threads, &tt, Some(&halt_receiver)) else { return; };
                     stdout_sender.send(UciResponse::BestMove(best_move.uci())).expect("stdout error");
                 }
             },
@@ -175,7 +181,18 @@ fn parse_uci_command(command: &str) -> Option<UciCommand> {
     match words.next()? {
         "uci" => Some(UciCommand::Uci),
         "setoption" => {
-            todo!()
+            // setoption name <id> [value <x>], where the id can have spaces and isn't case-sensitive
+            if words.next()? != "name" { return None; }
+            let name = (&mut words).take_while(|&word| word != "value").collect::<Vec<&str>>().join(" ");
+            let value = words.next();
+
+            match name.to_lowercase().as_str() {
+                "threads" => {
+                    let threads = value?.parse::<usize>().ok()?;
+                    Some(UciCommand::SetOption { option: UciOption::Threads(threads.clamp(1, engine::MAX_THREADS)) })
+                },
+                _ => None
+            }
         },
         "position" => {
             let fen = match words.next()? {
@@ -1,4 +1,4 @@
-use crate::chess::{Board, COLORS, NUM_COLORS, NUM_FILES, NUM_PIECES, NUM_SQUARES, PIECES};
+use crate::chess::{Board, Castles, Color, Piece, Square, COLORS, NUM_COLORS, NUM_FILES, NUM_PIECES, NUM_SQUARES, PIECES};
 use crate::prng::PRNG;
 
 const NUM_CASTLES: usize = 16;
@@ -51,6 +51,26 @@ impl ZobristHasher {
         Self { pieces, side_to_move, castles, en_passant }
     }
 
+    #[inline(always)]
+    pub const fn piece(&self, piece: Piece, color: Color, square: Square) -> u64 {
+        self.pieces[color.idx()][piece.idx()][square.idx()]
+    }
+
+    #[inline(always)]
+    pub const fn side_to_move(&self) -> u64 {
+        self.side_to_move
+    }
+
+    #[inline(always)]
+    pub const fn castles(&self, castles: Castles) -> u64 {
+        self.castles[castles.idx()]
+    }
+
+    #[inline(always)]
+    pub const fn en_passant(&self, square: Square) -> u64 {
+        self.en_passant[square.file().idx()]
+    }
+
     pub fn hash(&self, board: &Board) -> u64 {
         let mut hash = 0;
 